@@ -14,6 +14,7 @@ from datetime import datetime
 from dotenv import load_dotenv
 from gtts import gTTS
 from langdetect import detect, LangDetectException
+from embedding_store import EmbeddingStore, IndexBuildInProgress
 
 # Load environment variables from .env if present
 load_dotenv()
@@ -128,6 +129,41 @@ if not os.path.exists(model_path):
 
 model = load_model(model_path, compile=False)
 
+# Expose the features feeding the Dense classifier head alongside the class
+# scores so a single forward pass yields both the prediction and the embedding.
+# This only makes sense for a single-input model whose head sits on a flat
+# (pooled) feature vector; for any other architecture predictions use the plain
+# model and similar-case search is switched off.
+feature_model = None
+classifier_head = model.layers[-1]
+try:
+    if (
+        len(model.inputs) == 1
+        and isinstance(classifier_head, tf.keras.layers.Dense)
+        and len(classifier_head.input.shape) == 2
+    ):
+        feature_model = tf.keras.Model(inputs=model.inputs, outputs=[classifier_head.input, model.output])
+    else:
+        app.logger.warning(
+            "Similar-case search disabled: expected a single-input model ending in a Dense "
+            f"classifier over pooled features, got {len(model.inputs)} input(s) and a final "
+            f"{type(classifier_head).__name__} layer"
+        )
+except Exception as e:
+    app.logger.warning(f"Similar-case search disabled: cannot extract embeddings ({e})")
+
+# ================= Similar-Case Store =================
+embedding_dir = os.environ.get("EMBEDDING_STORE_DIR") or os.path.join(os.path.dirname(__file__), "embeddings")
+embedding_index_rows = int(os.environ.get("EMBEDDING_INDEX_MIN_ROWS", "50000"))
+embedding_store = None
+if feature_model is not None:
+    try:
+        embedding_store = EmbeddingStore(
+            embedding_dir, int(feature_model.outputs[0].shape[-1]), auto_index_rows=embedding_index_rows
+        )
+    except Exception as e:
+        app.logger.warning(f"Similar-case search disabled: {e}")
+
 class_names = [
 "Apple___Apple_scab",
 "Apple___Black_rot",
@@ -269,7 +305,10 @@ def predict():
             return jsonify({'error': 'No image provided'}), 400
 
         processed_image = preprocess_image(data['image'])
-        predictions = model.predict(processed_image)
+        if feature_model is not None:
+            embeddings, predictions = feature_model.predict(processed_image, verbose=0)
+        else:
+            embeddings, predictions = None, model.predict(processed_image, verbose=0)
         predicted_class_idx = np.argmax(predictions[0])
         confidence = float(np.max(predictions[0]) * 100)
         predicted_class = class_names[predicted_class_idx]
@@ -283,10 +322,79 @@ def predict():
             'isHealthy': is_healthy,
             'treatment': treatment
         }
+        if embedding_store is not None and data.get('store', True):
+            # A storage failure must not cost the user their diagnosis.
+            try:
+                result['caseId'] = embedding_store.add(embeddings[0], {
+                    'disease': predicted_class,
+                    'confidence': round(confidence, 2),
+                    'timestamp': str(datetime.now())
+                })
+            except Exception as e:
+                app.logger.error(f"Could not store embedding: {e}")
+        if embeddings is not None and data.get('returnEmbedding'):
+            result['embedding'] = embeddings[0].tolist()
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/similar', methods=['POST'])
+def similar():
+    if embedding_store is None:
+        return jsonify({'error': 'Similar-case search is not available'}), 503
+    try:
+        data = request.get_json() or {}
+        try:
+            k = int(data.get('k', 5))
+            nprobe = int(data.get('nprobe', 8))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'k and nprobe must be integers'}), 400
+        if k < 1 or nprobe < 1:
+            return jsonify({'error': 'k and nprobe must be at least 1'}), 400
+        exclude_id = None
+
+        if 'caseId' in data:
+            query = embedding_store.get_vector(data['caseId'])
+            if query is None:
+                return jsonify({'error': 'Unknown caseId'}), 404
+            exclude_id = data['caseId']
+        elif 'image' in data:
+            processed_image = preprocess_image(data['image'])
+            embeddings, _ = feature_model.predict(processed_image, verbose=0)
+            query = embeddings[0]
+        else:
+            return jsonify({'error': 'Provide caseId or image'}), 400
+
+        matches = embedding_store.search(query, k=k, nprobe=nprobe, exclude_id=exclude_id)
+        for match in matches:
+            match['disease'] = match['disease'].replace('_', ' ').replace('  ', ' ')
+        return jsonify({'matches': matches, 'total': len(embedding_store), 'indexed': embedding_store.has_index})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/similar/index', methods=['POST'])
+def build_similar_index():
+    if embedding_store is None:
+        return jsonify({'error': 'Similar-case search is not available'}), 503
+    try:
+        data = request.get_json(silent=True) or {}
+        n_clusters = data.get('clusters')
+        if n_clusters is not None:
+            try:
+                n_clusters = int(n_clusters)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'clusters must be an integer'}), 400
+            if n_clusters < 1:
+                return jsonify({'error': 'clusters must be at least 1'}), 400
+        if len(embedding_store) == 0:
+            return jsonify({'error': 'No embeddings stored yet'}), 409
+        n_clusters = embedding_store.build_index(n_clusters)
+        return jsonify({'clusters': n_clusters, 'total': len(embedding_store)})
+    except IndexBuildInProgress as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'message': 'Plant Disease Detection API is running'})
@@ -305,4 +413,8 @@ if __name__ == '__main__':
     print("🌱 Starting Plant Disease Detection API...")
     print(f"📂 Model loaded from: {model_path}")
     print(f"🌾 Number of classes: {len(class_names)}")
+    if embedding_store is not None:
+        print(f"🗂️ Stored embeddings: {len(embedding_store)} ({embedding_dir})")
+    else:
+        print("🗂️ Similar-case search disabled")
     app.run(host='0.0.0.0', port=5000)
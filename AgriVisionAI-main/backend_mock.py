@@ -4,6 +4,7 @@ import base64
 import io
 from PIL import Image
 import random
+import uuid
 from datetime import datetime
 
 app = Flask(__name__)
@@ -94,6 +95,9 @@ treatment_data = {
     }
 }
 
+# Mock similar-case store: previous predictions kept in memory
+mock_cases = []
+
 def preprocess_image(image_data):
     """Preprocess image for model prediction (mock version)"""
     try:
@@ -149,11 +153,73 @@ def predict():
             'treatment': treatment
         }
         
+        if data.get('store', True):
+            case = {
+                'id': uuid.uuid4().hex,
+                'disease': predicted_class,
+                'confidence': confidence,
+                'timestamp': str(datetime.now())
+            }
+            mock_cases.append(case)
+            result['caseId'] = case['id']
+        
         return jsonify(result)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/similar', methods=['POST'])
+def similar():
+    try:
+        data = request.get_json() or {}
+        try:
+            k = int(data.get('k', 5))
+            nprobe = int(data.get('nprobe', 8))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'k and nprobe must be integers'}), 400
+        if k < 1 or nprobe < 1:
+            return jsonify({'error': 'k and nprobe must be at least 1'}), 400
+        
+        exclude_id = None
+        if 'caseId' in data:
+            if not any(case['id'] == data['caseId'] for case in mock_cases):
+                return jsonify({'error': 'Unknown caseId'}), 404
+            exclude_id = data['caseId']
+        elif 'image' in data:
+            preprocess_image(data['image'])
+        else:
+            return jsonify({'error': 'Provide caseId or image'}), 400
+        
+        # Mock search - random previous cases with random descending scores
+        candidates = [case for case in mock_cases if case['id'] != exclude_id]
+        picked = random.sample(candidates, min(k, len(candidates)))
+        scores = sorted((round(random.uniform(0.6, 0.99), 4) for _ in picked), reverse=True)
+        matches = [
+            dict(case, disease=case['disease'].replace('_', ' ').replace('  ', ' '), score=score)
+            for case, score in zip(picked, scores)
+        ]
+        return jsonify({'matches': matches, 'total': len(mock_cases), 'indexed': False})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/similar/index', methods=['POST'])
+def build_similar_index():
+    data = request.get_json(silent=True) or {}
+    n_clusters = data.get('clusters')
+    if n_clusters is not None:
+        try:
+            n_clusters = int(n_clusters)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'clusters must be an integer'}), 400
+        if n_clusters < 1:
+            return jsonify({'error': 'clusters must be at least 1'}), 400
+    if not mock_cases:
+        return jsonify({'error': 'No embeddings stored yet'}), 409
+    if n_clusters is None:
+        n_clusters = max(1, int(len(mock_cases) ** 0.5))
+    return jsonify({'clusters': min(n_clusters, len(mock_cases)), 'total': len(mock_cases)})
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
@@ -0,0 +1,479 @@
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# ================= Embedding Store =================
+# Append-only float16 matrix on disk (vectors.f16) with a JSON-lines sidecar
+# (meta.jsonl) holding one {id, ...metadata} record per row, and info.json
+# recording the row layout. Rows are L2-normalised before they are written, so
+# cosine similarity is a dot product. An optional coarse IVF index (ivf.npz)
+# keeps a cluster-ordered int8 copy of the rows (one scale per row) so a query
+# scores only the few contiguous clusters closest to it, then re-scores the best
+# candidates exactly from the float16 rows.
+#
+# Appends are serialised across processes (e.g. several gunicorn workers) with
+# a lock file, and each process picks up rows and index builds made by others.
+
+VECTORS_FILE = "vectors.f16"
+META_FILE = "meta.jsonl"
+INFO_FILE = "info.json"
+INDEX_FILE = "ivf.npz"
+APPEND_LOCK_FILE = "append.lock"
+INDEX_LOCK_FILE = "index.lock"
+
+DTYPE = "float16"
+SCAN_CHUNK_ROWS = 8192
+MAX_SAMPLE_ROWS = 25000
+# Approximate int8 candidates re-scored exactly per requested result.
+RERANK_FACTOR = 8
+
+
+class StoreFormatError(ValueError):
+    """The files on disk were written with a different layout than requested."""
+
+
+class IndexBuildInProgress(RuntimeError):
+    """Another thread or process is already building the index."""
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, k):
+    """Return (positions, scores) of the k largest scores, best first."""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    part = np.argpartition(-scores, k - 1)[:k]
+    order = part[np.argsort(-scores[part])]
+    return order, scores[order]
+
+
+def _truncate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) != size:
+        with open(path, "r+b") as f:
+            f.truncate(size)
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+@contextmanager
+def _file_lock(path, blocking=True):
+    """Exclusive inter-process lock on `path`. Raises BlockingIOError if not blocking and held."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            except OSError as e:
+                if blocking:
+                    raise
+                raise BlockingIOError(str(e)) from e
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_records(path, offset):
+    """Parse complete JSON lines from byte `offset`; stop at a torn or bad line.
+
+    Returns the records and the byte offset just past each of them.
+    """
+    records, ends = [], []
+    if not os.path.exists(path):
+        return records, ends
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                break
+            offset += len(line)
+            records.append(record)
+            ends.append(offset)
+    return records, ends
+
+
+def _assign(matrix, centroids, start, stop):
+    """Nearest-centroid label for rows [start, stop) of matrix, scanned in chunks."""
+    labels = np.empty(stop - start, dtype=np.int32)
+    for offset in range(start, stop, SCAN_CHUNK_ROWS):
+        chunk = np.asarray(matrix[offset:min(offset + SCAN_CHUNK_ROWS, stop)], dtype=np.float32)
+        labels[offset - start:offset - start + chunk.shape[0]] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def _inverted_lists(assignments, n_clusters):
+    """Group row numbers by cluster; each list stays in ascending row order."""
+    order = np.argsort(assignments, kind="stable")
+    bounds = np.cumsum(np.bincount(assignments, minlength=n_clusters))[:-1]
+    return np.split(order, bounds)
+
+
+class EmbeddingStore:
+    def __init__(self, directory, dim, auto_index_rows=None):
+        self.directory = directory
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(DTYPE).itemsize
+        # Build the IVF index in the background once this many rows are stored,
+        # and rebuild it whenever the store has doubled since the last build.
+        self.auto_index_rows = auto_index_rows
+        self.vectors_path = os.path.join(directory, VECTORS_FILE)
+        self.meta_path = os.path.join(directory, META_FILE)
+        self.info_path = os.path.join(directory, INFO_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.append_lock_path = os.path.join(directory, APPEND_LOCK_FILE)
+        self.index_lock_path = os.path.join(directory, INDEX_LOCK_FILE)
+        self._lock = threading.Lock()
+        self._matrix = np.empty((0, dim), dtype=DTYPE)
+        self._meta = []
+        self._meta_bytes = 0
+        self._row_by_id = {}
+        # (centroids, offsets, order, cluster-ordered int8 codes, per-row scales,
+        # per-cluster rows added since the build), swapped as one attribute so a concurrent
+        # search never mixes parts of two builds.
+        self._index = None
+        self._index_rows = 0
+        self._index_stamp = None
+        self._building = False
+        os.makedirs(directory, exist_ok=True)
+        with self._lock, _file_lock(self.append_lock_path):
+            self._check_info()
+            self._sync()
+            self._load_index()
+
+    # ---------- loading ----------
+    def _check_info(self):
+        info = {"dim": self.dim, "dtype": DTYPE}
+        if os.path.exists(self.info_path):
+            with open(self.info_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored != info:
+                raise StoreFormatError(
+                    f"Embedding store at {self.directory} holds {stored}, expected {info}; "
+                    "use a new EMBEDDING_STORE_DIR for this model"
+                )
+            return
+
+        # Stores written before info.json existed are only adopted when their
+        # size matches this layout exactly; recovery never truncates on a guess.
+        rows = len(_read_records(self.meta_path, 0)[0])
+        if _file_size(self.vectors_path) != rows * self.row_bytes:
+            raise StoreFormatError(
+                f"Cannot verify the layout of the embedding store at {self.directory}; "
+                "use a new EMBEDDING_STORE_DIR"
+            )
+        tmp_path = self.info_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        os.replace(tmp_path, self.info_path)
+
+    def _sync(self):
+        """Pick up rows committed by any process. Caller holds both locks.
+
+        A crash mid-append leaves the two files out of step; only rows present
+        in both are committed, and both files are cut back to that point so
+        later appends stay aligned.
+        """
+        records, ends = _read_records(self.meta_path, self._meta_bytes)
+        stored_rows = _file_size(self.vectors_path) // self.row_bytes
+        start = len(self._meta)
+        take = max(0, min(stored_rows - start, len(records)))
+        if take:
+            self._meta.extend(records[:take])
+            self._meta_bytes = ends[take - 1]
+            self._remap()
+            for row in range(start, start + take):
+                self._row_by_id[self._meta[row]["id"]] = row
+            self._index_new_rows(start, start + take)
+        _truncate(self.vectors_path, len(self._meta) * self.row_bytes)
+        _truncate(self.meta_path, self._meta_bytes)
+
+    def _remap(self):
+        count = len(self._meta)
+        if count == 0:
+            self._matrix = np.empty((0, self.dim), dtype=DTYPE)
+        else:
+            self._matrix = np.memmap(self.vectors_path, dtype=DTYPE, mode="r", shape=(count, self.dim))
+
+    def _index_stat(self):
+        if not os.path.exists(self.index_path):
+            return None
+        st = os.stat(self.index_path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load_index(self):
+        """(Re)load ivf.npz and its cluster-ordered codes. Caller holds the locks."""
+        self._index_stamp = self._index_stat()
+        self._index = None
+        self._index_rows = 0
+        if self._index_stamp is None:
+            return
+        with np.load(self.index_path) as data:
+            if "codes_file" not in data.files:
+                return
+            centroids = data["centroids"].astype(np.float32)
+            offsets = data["offsets"]
+            order = data["order"]
+            scales = data["scales"]
+            codes_path = os.path.join(self.directory, str(data["codes_file"]))
+        covered = len(order)
+        if (
+            centroids.shape[1] != self.dim
+            or covered > len(self._meta)
+            or _file_size(codes_path) != covered * self.dim
+        ):
+            return
+
+        if covered:
+            codes = np.memmap(codes_path, dtype=np.int8, mode="r", shape=(covered, self.dim))
+        else:
+            codes = np.empty((0, self.dim), dtype=np.int8)
+        count = len(self._meta)
+        new_rows = _inverted_lists(_assign(self._matrix, centroids, covered, count), len(centroids))
+        tails = [rows + covered for rows in new_rows]
+        self._index = (centroids, offsets, order, codes, scales, tails)
+        self._index_rows = covered
+
+    def _index_new_rows(self, start, stop):
+        if self._index is None or start == stop:
+            return
+        centroids, tails = self._index[0], self._index[-1]
+        labels = _assign(self._matrix, centroids, start, stop)
+        rows = np.arange(start, stop)
+        for cluster in np.unique(labels):
+            tails[cluster] = np.concatenate([tails[cluster], rows[labels == cluster]])
+
+    def _refresh(self):
+        """Cheaply check for rows or an index written by another process."""
+        if _file_size(self.meta_path) == self._meta_bytes and self._index_stat() == self._index_stamp:
+            return
+        with self._lock, _file_lock(self.append_lock_path):
+            self._sync()
+            if self._index_stat() != self._index_stamp:
+                self._load_index()
+
+    # ---------- public API ----------
+    def __len__(self):
+        return len(self._meta)
+
+    @property
+    def has_index(self):
+        return self._index is not None
+
+    def get_vector(self, case_id):
+        row = self._row_by_id.get(case_id)
+        if row is None:
+            self._refresh()
+            row = self._row_by_id.get(case_id)
+            if row is None:
+                return None
+        return np.asarray(self._matrix[row], dtype=np.float32)
+
+    def add(self, embedding, metadata=None):
+        """Append one embedding with its metadata and return the new case id."""
+        vector = _normalize(np.ravel(embedding))
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected embedding of size {self.dim}, got {vector.shape[0]}")
+        record = {"id": uuid.uuid4().hex}
+        record.update(metadata or {})
+        vector_bytes = vector.astype(DTYPE).tobytes()
+        line = (json.dumps(record) + "\n").encode("utf-8")
+
+        with self._lock, _file_lock(self.append_lock_path):
+            self._sync()
+            row = len(self._meta)
+            try:
+                with open(self.vectors_path, "ab") as f:
+                    f.write(vector_bytes)
+                with open(self.meta_path, "ab") as f:
+                    f.write(line)
+            except Exception:
+                # Roll both files back so the next append stays aligned.
+                _truncate(self.vectors_path, row * self.row_bytes)
+                _truncate(self.meta_path, self._meta_bytes)
+                raise
+
+            self._meta.append(record)
+            self._meta_bytes += len(line)
+            self._remap()
+            self._row_by_id[record["id"]] = row
+            self._index_new_rows(row, row + 1)
+
+            start_build = (
+                self.auto_index_rows is not None
+                and not self._building
+                and row + 1 >= self.auto_index_rows
+                and row + 1 >= 2 * self._index_rows
+            )
+            if start_build:
+                self._building = True
+        if start_build:
+            threading.Thread(target=self._auto_build, daemon=True).start()
+        return record["id"]
+
+    def _auto_build(self):
+        try:
+            self._build()
+        except IndexBuildInProgress:
+            pass
+        except Exception as e:
+            print(f"⚠️ Embedding index build failed: {e}")
+        finally:
+            self._building = False
+
+    def build_index(self, n_clusters=None, iterations=10, sample_size=None, seed=0):
+        """Train a coarse spherical k-means (IVF) index over the stored rows."""
+        with self._lock:
+            if self._building:
+                raise IndexBuildInProgress("An index build is already in progress")
+            self._building = True
+        try:
+            return self._build(n_clusters, iterations, sample_size, seed)
+        finally:
+            self._building = False
+
+    def _build(self, n_clusters=None, iterations=10, sample_size=None, seed=0):
+        try:
+            with _file_lock(self.index_lock_path, blocking=False):
+                return self._build_locked(n_clusters, iterations, sample_size, seed)
+        except BlockingIOError as e:
+            raise IndexBuildInProgress("An index build is already in progress") from e
+
+    def _build_locked(self, n_clusters, iterations, sample_size, seed):
+        # Train, assign and write the cluster-ordered copy against a snapshot
+        # without holding the append lock, so add() is never blocked behind a
+        # long build.
+        with self._lock:
+            matrix = self._matrix
+        count = matrix.shape[0]
+        if count == 0:
+            raise ValueError("No embeddings stored yet")
+        if n_clusters is None:
+            n_clusters = int(np.sqrt(count))
+        n_clusters = max(1, min(n_clusters, count))
+        if sample_size is None:
+            sample_size = min(32 * n_clusters, MAX_SAMPLE_ROWS)
+        sample_size = max(n_clusters, min(sample_size, count))
+
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(count, size=sample_size, replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        grouped = np.empty_like(sample)
+        centroids = sample[rng.choice(sample_size, size=n_clusters, replace=False)]
+        for _ in range(iterations):
+            labels = _assign(sample, centroids, 0, sample_size)
+            order = np.argsort(labels, kind="stable")
+            sizes = np.bincount(labels, minlength=n_clusters)
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+            filled = sizes > 0
+            np.take(sample, order, axis=0, out=grouped)
+            sums = centroids.copy()
+            sums[filled] = np.add.reduceat(grouped, starts[filled], axis=0)
+            centroids = _normalize(sums)
+        del sample, grouped
+
+        assignments = _assign(matrix, centroids, 0, count)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_clusters))])
+
+        # int8 converts to float32 several times faster than float16, which
+        # dominates query time once the rows are contiguous.
+        codes_file = f"ivf-{uuid.uuid4().hex}.i8"
+        scales = np.empty(count, dtype=np.float32)
+        with open(os.path.join(self.directory, codes_file), "wb") as f:
+            for start in range(0, count, SCAN_CHUNK_ROWS):
+                chunk = np.asarray(matrix[order[start:start + SCAN_CHUNK_ROWS]], dtype=np.float32)
+                scale = np.maximum(np.abs(chunk).max(axis=1), 1e-12) / 127
+                scales[start:start + chunk.shape[0]] = scale
+                f.write(np.rint(chunk / scale[:, None]).astype(np.int8).tobytes())
+
+        with self._lock, _file_lock(self.append_lock_path):
+            old_codes_file = None
+            if os.path.exists(self.index_path):
+                with np.load(self.index_path) as data:
+                    if "codes_file" in data.files:
+                        old_codes_file = str(data["codes_file"])
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f, centroids=centroids, offsets=offsets, order=order, scales=scales, codes_file=codes_file
+                )
+            os.replace(tmp_path, self.index_path)
+            self._load_index()
+        if old_codes_file:
+            try:
+                os.remove(os.path.join(self.directory, old_codes_file))
+            except OSError:
+                # Still mapped by a reader (Windows); left for a later build.
+                pass
+        return n_clusters
+
+    def search(self, query, k=5, nprobe=8, exclude_id=None):
+        """Top-k cosine search. Uses the IVF index when built, else a chunked full scan."""
+        if k < 1 or nprobe < 1:
+            raise ValueError("k and nprobe must be at least 1")
+        self._refresh()
+        q = _normalize(np.ravel(query))
+        index = self._index
+        want = k + (1 if exclude_id is not None else 0)
+
+        if index is not None:
+            centroids, offsets, order, codes, scales, tails = index
+            probe = _top_k(centroids @ q, nprobe)[0]
+            rows, approx = [], []
+            for c in probe:
+                lo, hi = offsets[c], offsets[c + 1]
+                rows.append(order[lo:hi])
+                approx.append((codes[lo:hi] @ q) * scales[lo:hi])
+            rows = np.concatenate(rows)
+            pos = _top_k(np.concatenate(approx), RERANK_FACTOR * want)[0]
+            # Rows added since the build have no codes and are scored exactly.
+            # Read the matrix after the tails: every listed row is already mapped.
+            candidates = np.sort(np.concatenate([rows[pos]] + [tails[c] for c in probe]))
+            matrix = self._matrix
+            scores = np.asarray(matrix[candidates], dtype=np.float32) @ q
+            pos, best = _top_k(scores, want)
+            best_rows = candidates[pos]
+        else:
+            matrix = self._matrix
+            best_rows = np.empty(0, dtype=np.int64)
+            best = np.empty(0, dtype=np.float32)
+            for start in range(0, matrix.shape[0], SCAN_CHUNK_ROWS):
+                scores = np.asarray(matrix[start:start + SCAN_CHUNK_ROWS], dtype=np.float32) @ q
+                pos, chunk_best = _top_k(scores, want)
+                best_rows = np.concatenate([best_rows, pos + start])
+                best = np.concatenate([best, chunk_best])
+                keep, best = _top_k(best, want)
+                best_rows = best_rows[keep]
+
+        results = []
+        for row, score in zip(best_rows, best):
+            record = self._meta[row]
+            if record["id"] == exclude_id:
+                continue
+            results.append(dict(record, score=round(float(score), 4)))
+        return results[:k]
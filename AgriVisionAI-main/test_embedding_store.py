@@ -0,0 +1,201 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from embedding_store import EmbeddingStore, INFO_FILE, META_FILE, StoreFormatError, VECTORS_FILE
+
+DIM = 16
+
+
+@pytest.fixture
+def vectors():
+    return np.random.default_rng(0).normal(size=(400, DIM)).astype(np.float32)
+
+
+def fill(store, vectors):
+    return [store.add(v, {"disease": f"class_{i % 5}"}) for i, v in enumerate(vectors)]
+
+
+def test_add_get_and_search_order(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    ids = fill(store, vectors)
+
+    assert len(store) == len(vectors)
+    np.testing.assert_allclose(
+        store.get_vector(ids[3]), vectors[3] / np.linalg.norm(vectors[3]), atol=1e-3
+    )
+    assert store.get_vector("missing") is None
+
+    matches = store.search(vectors[7], k=4)
+    assert matches[0]["id"] == ids[7]
+    assert matches[0]["disease"] == "class_2"
+    scores = [m["score"] for m in matches]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_exclude_id(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    ids = fill(store, vectors)
+
+    matches = store.search(store.get_vector(ids[7]), k=3, exclude_id=ids[7])
+    assert len(matches) == 3
+    assert ids[7] not in [m["id"] for m in matches]
+
+
+def test_rejects_bad_arguments(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    fill(store, vectors[:5])
+
+    with pytest.raises(ValueError):
+        store.search(vectors[0], k=0)
+    with pytest.raises(ValueError):
+        store.search(vectors[0], nprobe=0)
+    with pytest.raises(ValueError):
+        store.add(np.zeros(DIM + 1))
+
+
+def test_ivf_matches_full_scan_when_probing_all_clusters(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    fill(store, vectors)
+    queries = vectors[:20] + 0.1
+
+    exact = [[m["id"] for m in store.search(q, k=5)] for q in queries]
+    n_clusters = store.build_index(8)
+    assert store.has_index
+    approx = [[m["id"] for m in store.search(q, k=5, nprobe=n_clusters)] for q in queries]
+    assert approx == exact
+
+
+def test_reload_after_torn_meta_line(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    ids = fill(store, vectors[:10])
+    with open(tmp_path / META_FILE, "a", encoding="utf-8") as f:
+        f.write('{"id": "abc", "dis')
+
+    reloaded = EmbeddingStore(str(tmp_path), DIM)
+    assert len(reloaded) == 10
+    new_id = reloaded.add(vectors[10])
+
+    again = EmbeddingStore(str(tmp_path), DIM)
+    assert len(again) == 11
+    assert again.search(vectors[10], k=1)[0]["id"] == new_id
+    assert again.search(vectors[4], k=1)[0]["id"] == ids[4]
+
+
+def test_reload_after_extra_meta_record(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    fill(store, vectors[:10])
+    with open(tmp_path / META_FILE, "a", encoding="utf-8") as f:
+        f.write('{"id": "orphan"}\n')
+
+    reloaded = EmbeddingStore(str(tmp_path), DIM)
+    assert len(reloaded) == 10
+    new_id = reloaded.add(vectors[10])
+
+    again = EmbeddingStore(str(tmp_path), DIM)
+    assert len(again) == 11
+    assert again.get_vector("orphan") is None
+    assert again.search(vectors[10], k=1)[0]["id"] == new_id
+
+
+def test_reload_after_extra_vector_bytes(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    fill(store, vectors[:10])
+    with open(tmp_path / VECTORS_FILE, "ab") as f:
+        f.write(b"\0" * (DIM * 2 + 3))
+
+    reloaded = EmbeddingStore(str(tmp_path), DIM)
+    assert len(reloaded) == 10
+    assert os.path.getsize(tmp_path / VECTORS_FILE) == 10 * DIM * 2
+    new_id = reloaded.add(vectors[10])
+    assert EmbeddingStore(str(tmp_path), DIM).search(vectors[10], k=1)[0]["id"] == new_id
+
+
+def test_index_reload_with_rows_added_after_save(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    ids = fill(store, vectors[:300])
+    store.build_index(6)
+    ids += fill(store, vectors[300:])
+
+    reloaded = EmbeddingStore(str(tmp_path), DIM)
+    assert reloaded.has_index
+    for i in (10, 350, 399):
+        assert reloaded.search(vectors[i], k=1, nprobe=6)[0]["id"] == ids[i]
+
+
+def test_auto_index_builds_past_threshold(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM, auto_index_rows=100)
+    fill(store, vectors[:99])
+    assert not store.has_index
+    store.add(vectors[99])
+    for _ in range(500):
+        if store.has_index:
+            break
+        time.sleep(0.01)
+    assert store.has_index
+
+
+def test_failed_metadata_write_rolls_back_vector(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    fill(store, vectors[:10])
+    meta_path = store.meta_path
+    store.meta_path = str(tmp_path / "missing" / META_FILE)
+    with pytest.raises(OSError):
+        store.add(vectors[10])
+    store.meta_path = meta_path
+
+    assert len(store) == 10
+    assert os.path.getsize(tmp_path / VECTORS_FILE) == 10 * DIM * 2
+    new_id = store.add(vectors[11])
+    assert EmbeddingStore(str(tmp_path), DIM).search(vectors[11], k=1)[0]["id"] == new_id
+
+
+def test_reopen_with_other_dim_refuses_and_keeps_data(tmp_path, vectors):
+    store = EmbeddingStore(str(tmp_path), DIM)
+    ids = fill(store, vectors[:10])
+
+    with pytest.raises(StoreFormatError):
+        EmbeddingStore(str(tmp_path), DIM // 2)
+    assert os.path.getsize(tmp_path / VECTORS_FILE) == 10 * DIM * 2
+
+    reopened = EmbeddingStore(str(tmp_path), DIM)
+    assert len(reopened) == 10
+    assert reopened.search(vectors[4], k=1)[0]["id"] == ids[4]
+
+
+def test_store_without_info_is_only_adopted_when_sizes_match(tmp_path, vectors):
+    fill(EmbeddingStore(str(tmp_path), DIM), vectors[:10])
+    os.remove(tmp_path / INFO_FILE)
+
+    with pytest.raises(StoreFormatError):
+        EmbeddingStore(str(tmp_path), DIM // 2)
+    assert os.path.getsize(tmp_path / VECTORS_FILE) == 10 * DIM * 2
+    assert len(EmbeddingStore(str(tmp_path), DIM)) == 10
+
+
+def test_two_writers_stay_aligned(tmp_path, vectors):
+    first = EmbeddingStore(str(tmp_path), DIM)
+    second = EmbeddingStore(str(tmp_path), DIM)
+    ids = [(first if i % 2 else second).add(v) for i, v in enumerate(vectors[:40])]
+
+    assert first.search(vectors[10], k=1)[0]["id"] == ids[10]
+    assert second.get_vector(ids[11]) is not None
+    reopened = EmbeddingStore(str(tmp_path), DIM)
+    assert len(reopened) == 40
+    for i in range(40):
+        assert reopened.search(vectors[i], k=1)[0]["id"] == ids[i]
+
+
+def test_other_writer_picks_up_rebuilt_index(tmp_path, vectors):
+    first = EmbeddingStore(str(tmp_path), DIM)
+    second = EmbeddingStore(str(tmp_path), DIM)
+    ids = fill(first, vectors[:200])
+    first.build_index(4)
+    ids += fill(first, vectors[200:300])
+    first.build_index(6)
+
+    assert len(list(tmp_path.glob("ivf-*.i8"))) == 1
+    assert second.search(vectors[250], k=1, nprobe=6)[0]["id"] == ids[250]
+    assert second.has_index